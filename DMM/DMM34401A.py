@@ -3,25 +3,87 @@
 @author: Suhash - Updated on Oct 07 2022
 """
 
+import os
+import sys
 import time
+import queue
+import select
+import selectors
+import threading
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import serial
 import serial.tools.list_ports
 
-def read_ports():
-    """Find ports to DMM by assuming USB connection.
+# Upper bound on rows allocated up front by read_DMMs; longer runs grow the buffer as needed
+MAX_PREALLOC_ROWS = 65536
+
+# Number of readings the DMM's reading memory holds, which limits a burst
+MAX_BURST = 512
+
+# Time in sec a read_ports scan is reused for
+PORT_CACHE_TIME = 2.0
+_PORT_CACHE = {"t": 0.0, "ports": None}
+
+# USB vendor IDs of USB-serial adapter chips the DMMs are connected through
+_ADAPTER_VIDS = {
+    0x067B, # Prolific (PL2303)
+    0x0403, # FTDI
+    0x10C4, # Silicon Labs (CP210x)
+    0x1A86, # WCH (CH340)
+}
+
+# SCPI commands, pre-encoded so the read path does not build strings per sample
+_CMD_READ = b"READ?\n"
+_CMD_IDN = b"*IDN?\n"
+_CMD_REMOTE = b"SYSTem:REMote\n"
+_CMD_TRIG = b"TRIG:SOUR %s\n"
+_CMD_TRIG_DEL = b"TRIG:DEL %f\n"
+_CMD_SAMP_COUN = b"SAMP:COUN %d\n"
+_CMD_INIT = b"INIT\n"
+_CMD_TRG = b"*TRG\n"
+_CMD_OPC = b"*OPC?\n"
+_CMD_FETCH = b"FETCh?\n"
+
+# Measurement mode -> CONFigure command template taking range and resolution
+_CONF_CMDS = {
+    "DCV": b"CONF:VOLT:DC %s, %s\n", # DC voltage
+    "ACV": b"CONF:VOLT:AC %s, %s\n", # AC voltage
+    "DCI": b"CONF:CURR:DC %s, %s\n", # DC current
+    "ACI": b"CONF:CURR:AC %s, %s\n", # AC current
+    "RES2": b"CONF:RES %s, %s\n", # 2-wire resistance
+    "RES4": b"CONF:FRES %s, %s\n", # 4-wire resistance
+    "FREQ": b"CONF:FREQ %s, %s\n", # Frequency
+    "PER": b"CONF:PER %s, %s\n", # Period
+}
+
+def read_ports(force=False):
+    """Find ports to DMM by assuming connection through a USB-serial adapter.
+
+    The port scan is cached for PORT_CACHE_TIME sec since listing ports walks the OS device tree.
+
+    Args:
+        force (bool, optional): Rescan ports even if a cached result is available. Defaults to False.
 
     Returns:
         list str: DMM ports.
     """
+    now = time.monotonic()
+    if not force and _PORT_CACHE["ports"] is not None and now - _PORT_CACHE["t"] < PORT_CACHE_TIME:
+        return list(_PORT_CACHE["ports"])
+
+    # The 34401A is RS-232 only, so match the adapter's vendor rather than the instrument's
     ports = []
     for comport in serial.tools.list_ports.comports():
-        if 'USB' in comport.description:
+        if comport.vid in _ADAPTER_VIDS:
             ports.append(comport.device)
 
-    return ports
+    _PORT_CACHE["t"] = now
+    _PORT_CACHE["ports"] = ports
+    return list(ports)
 
-def read_DMMs(conf, dmms=None, sleep_time=0, meas_time=10000, val_range=1, val_res=1e-6):
+def read_DMMs(conf, dmms=None, sleep_time=0, meas_time=10000, val_range=1, val_res=1e-6, batch=0, csv_path=None):
     """Take specified measurement from multiple DMMs at every period for a set amount of time.
 
     Args:
@@ -31,9 +93,15 @@ def read_DMMs(conf, dmms=None, sleep_time=0, meas_time=10000, val_range=1, val_r
         meas_time (int, optional): Total measurement time in sec. Defaults to 10000.
         val_range (int or list, optional): Approximate measurement range in standard units. Defaults to 1.
         val_res (float, optional): Measurement resolution in standard units. Defaults to 1e-6.
+        batch (int, optional): Samples per DMM to collect in one burst using the DMM's reading memory (max 512).
+            sleep_time is then the extra delay between samples within a burst. Sample times are spread evenly
+            between the trigger and the DMMs reporting the burst complete, averaged over the DMMs.
+            Ctrl-C returns immediately, but a burst in progress keeps its DMM busy until its readings are
+            transferred. Defaults to 0 (one READ? per sample).
+        csv_path (str, optional): File to stream measurements to as CSV instead of keeping them in memory. Defaults to None.
 
     Returns:
-        np.array: Array of collected measurements
+        np.array: Array of collected measurements, or None if streamed to csv_path.
     """
     # Find all DMM ports and create objects if DMMs are not provided
     if not dmms:
@@ -41,6 +109,10 @@ def read_DMMs(conf, dmms=None, sleep_time=0, meas_time=10000, val_range=1, val_r
     # If a single DMM is given not in a list, reformat to a list
     elif not isinstance(dmms, list):
         dmms = list(dmms)
+    if not dmms:
+        raise RuntimeError("No DMMs found. Check that the DMMs are connected and powered on.")
+    if not 0 <= batch <= MAX_BURST:
+        raise ValueError(f"batch must be between 0 and {MAX_BURST}, got {batch}")
 
     # Set measurement mode on DMMs
     # If a different range is needed per DMM, a list should be passed in the same order of the DMMs
@@ -53,42 +125,199 @@ def read_DMMs(conf, dmms=None, sleep_time=0, meas_time=10000, val_range=1, val_r
 
     time.sleep(10)
     print("Start Reading")
-    output = []
 
-    # Start time
-    tic = time.time()
+    # Preallocate the output from the expected number of samples and grow it if the run goes longer
+    # When streaming to CSV only the current block of rows is held
+    if csv_path:
+        n_rows = max(batch, 1)
+    else:
+        n_rows = min(int(meas_time / max(sleep_time, 1e-3)) + 16, MAX_PREALLOC_ROWS)
+    output = np.empty((n_rows, 1 + len(dmms)), dtype=np.float64)
+    i = 0
+
+    # Opened before any threads are started so a bad path cannot leave them running
+    csv = None
+    if csv_path:
+        csv = open(csv_path, 'wb', buffering=64*1024)
+        row_fmt = b"%10.8f" + b",%10.8f" * len(dmms) + b"\n"
+
+    # Each DMM sits on its own serial port, so reads are dispatched concurrently
+    # On POSIX all ports are waited on with one selector, elsewhere each reply gets a pool thread
+    pool = ThreadPoolExecutor(max_workers=len(dmms))
+    sel = selectors.DefaultSelector() if os.name == 'posix' else None
+
+    # Printing is handed to a background thread to keep it out of the sampling loop
+    rows = queue.SimpleQueue()
+    stop = object()
+    writer = threading.Thread(target=_writer, args=(rows, stop, sys.stdout), daemon=True)
+    writer.start()
+
+    # Start time, on the monotonic clock so wall-clock adjustments do not shift samples
+    tic = time.monotonic()
     toc = tic
+    # Samples are paced against a fixed time grid so read time and sleep overshoot do not accumulate
+    next_t = tic
 
     # Read DMMs
+    interrupted = False
     try:
         while (toc - tic) < meas_time:
-            toc = time.time()
-            measurements = []
-            for dmm in dmms:
-                measurements.append(dmm.read_meas())
+            toc = time.monotonic()
+            n = batch or 1
+            while i + n > n_rows:
+                n_rows *= 2
+                output = np.resize(output, (n_rows, output.shape[1]))
+
+            # Measurements are written straight into the output rows
+            block = output[i:i+n]
+            if batch:
+                futures = [pool.submit(dmm.read_burst, batch, sleep_time) for dmm in dmms]
+                spans = []
+                for j, future in enumerate(futures):
+                    block[:, j + 1], t_start, t_end = future.result()
+                    spans.append((t_start, t_end))
+                # Integration time adds to the trigger delay, so the burst is timed rather than assumed
+                t_start, t_end = np.mean(spans, axis=0) - tic
+                block[:, 0] = np.linspace(t_start, t_end, batch)
+            else:
+                block[0, 0] = toc - tic
+                if sel is not None:
+                    _select_read(dmms, sel, block[0, 1:])
+                else:
+                    _read_all(dmms, pool, block[0, 1:])
+
+            if csv is None:
+                i += n
+            else:
+                # Streamed rows are not kept, so the buffer is overwritten next iteration
+                csv.write((row_fmt * n) % tuple(block.ravel()))
+                block = block.copy()
+            rows.put(block)
+
+            # A pause is required between reads, skipped if the reads already overran the period
+            next_t += n * sleep_time
+            dt = next_t - time.monotonic()
+            if dt > 0:
+                time.sleep(dt)
 
-            vals = [(toc-tic)] + measurements
-            print(*vals, sep='\t')
-            output.append(vals)
+    except KeyboardInterrupt:
+        # End measurements
+        interrupted = True
 
-            # A pause is required between reads
-            time.sleep(sleep_time)
+    finally:
+        rows.put(stop)
+        writer.join()
+        # After Ctrl-C, return without waiting for in-flight bursts. Each one still reads its full reply
+        # under the DMM's lock, so the next command to that DMM waits for it and the port stays in sync
+        pool.shutdown(wait=not interrupted, cancel_futures=True)
+        if sel is not None:
+            sel.close()
+        if csv is not None:
+            csv.close()
 
-        return np.array(output)
+    if csv is not None:
+        return None
+    return output[:i]
 
-    except KeyboardInterrupt:
-        # End measurements
-        return np.array(output)
 
+def _writer(rows, stop, stream, max_rows=32, max_wait=0.05):
+    """Print blocks of measurement rows from a queue as tab-separated lines.
+
+    Blocks are gathered until max_rows rows or max_wait sec have built up, then written with a single write.
+
+    Args:
+        rows (queue.SimpleQueue): Queue of 2D arrays of rows to print.
+        stop (object): Sentinel put on the queue to end the thread.
+        stream (file): Text stream to write to.
+        max_rows (int, optional): Rows to gather before writing. Defaults to 32.
+        max_wait (float, optional): Maximum time to gather rows in sec. Defaults to 0.05.
+    """
+    done = False
+    while not done:
+        blocks = [rows.get()]
+        n = 0
+        deadline = time.monotonic() + max_wait
+        while True:
+            if blocks[-1] is stop:
+                blocks.pop()
+                done = True
+                break
+            n += len(blocks[-1])
+            remaining = deadline - time.monotonic()
+            if n >= max_rows or remaining <= 0:
+                break
+            try:
+                blocks.append(rows.get(timeout=remaining))
+            except queue.Empty:
+                break
+
+        if blocks:
+            stream.write(''.join('\t'.join(map(str, row)) + '\n' for block in blocks for row in block))
+            stream.flush()
+
+def _read_all(dmms, pool, out):
+    """Take one measurement from every DMM.
+
+    All READ? commands are sent before any reply is awaited so the DMMs measure in parallel.
+
+    Args:
+        dmms (list DMM34401A): DMM objects.
+        pool (ThreadPoolExecutor): Executor used to wait on the replies.
+        out (np.array): Row the measurements are written to, in the same order as dmms.
+    """
+    with ExitStack() as stack:
+        for dmm in dmms:
+            stack.enter_context(dmm.lock)
+            dmm.send_read()
+        futures = [pool.submit(dmm.recv_meas) for dmm in dmms]
+        for j, future in enumerate(futures):
+            out[j] = future.result()
+
+def _select_read(dmms, sel, out):
+    """Take one measurement from every DMM, waiting on all of their ports at once.
+
+    Replies are read in the order they arrive with a single thread. Only usable where serial ports are selectable (POSIX).
+
+    Args:
+        dmms (list DMM34401A): DMM objects.
+        sel (selectors.BaseSelector): Selector with no ports registered.
+        out (np.array): Row the measurements are written to, in the same order as dmms.
+    """
+    with ExitStack() as stack:
+        for dmm in dmms:
+            stack.enter_context(dmm.lock)
+            dmm.send_read()
 
-def init_DMMs():
+        pending = 0
+        for idx, dmm in enumerate(dmms):
+            value = dmm.poll_meas()
+            if value is None:
+                sel.register(dmm.ser.fileno(), selectors.EVENT_READ, idx)
+                pending += 1
+            else:
+                out[idx] = value
+
+        while pending:
+            for key, _ in sel.select():
+                dmm = dmms[key.data]
+                dmm._fill()
+                value = dmm.poll_meas()
+                if value is not None:
+                    out[key.data] = value
+                    sel.unregister(key.fd)
+                    pending -= 1
+
+def init_DMMs(force=False):
     """Create objects for all connected DMMs.
 
+    Args:
+        force (bool, optional): Rescan ports instead of using a recent cached scan. Defaults to False.
+
     Returns:
         list DMM34401A: DMM objects.
     """
     dmms = []
-    ports = read_ports()
+    ports = read_ports(force)
     for port in ports:
         dmm = DMM34401A(port)
         dmms.append(dmm)
@@ -108,7 +337,7 @@ def del_DMMs(dmms):
 class DMM34401A:
     """DMM object."""
 
-    def __init__(self, port_num, baudrate=9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_TWO, bytesize=serial.EIGHTBITS, xonxoff=True):
+    def __init__(self, port_num, baudrate=9600, parity=serial.PARITY_NONE, stopbits=serial.STOPBITS_TWO, bytesize=serial.EIGHTBITS, xonxoff=False, rtscts=False):
         """Initialize serial connection for DMM object.
 
         Args:
@@ -117,18 +346,34 @@ class DMM34401A:
             parity (str, optional): Serial parity. Defaults to serial.PARITY_NONE.
             stopbits (int, optional): Serial stop bits. Defaults to serial.STOPBITS_TWO.
             bytesize (int, optional): Serial byte size. Defaults to serial.EIGHTBITS.
-            xonxoff (bool, optional): Software flow control. Defaults to True.
+            xonxoff (bool, optional): Software flow control. Pass True for cables wired for XON/XOFF only. Defaults to False.
+            rtscts (bool, optional): RTS/CTS hardware flow control. Only enable if the cable wires CTS, otherwise writes block. Defaults to False.
         """
         self.ser = serial.Serial(port = port_num,
                                  baudrate = baudrate,
                                  parity = parity,
                                  stopbits = stopbits,
                                  bytesize = bytesize,
-                                 xonxoff = xonxoff)
+                                 xonxoff = xonxoff,
+                                 rtscts = rtscts)
+        # Keep each command/response pair atomic on the port
+        self.lock = threading.Lock()
+        # Reusable receive buffer for _readline, grown if a reply does not fit
+        self._rxbuf = bytearray(64)
+        self._rxmv = memoryview(self._rxbuf)
+        self._rxlen = 0
+
+        # Drop the USB-serial latency timer (16 ms on FTDI) to 1 ms where supported
+        # pyserial already puts the tty in raw mode, so only the ASYNC_LOW_LATENCY flag is needed
+        try:
+            self.ser.set_low_latency_mode(True)
+        except (AttributeError, NotImplementedError, ValueError):
+            # Not Linux, or the driver does not support the flag
+            pass
 
         time.sleep(0.5)
         if self.ser.is_open:
-            self.ser.write("SYSTem:REMote\n".encode())
+            self.ser.write(_CMD_REMOTE)
 
 
     def __del__(self):
@@ -136,7 +381,7 @@ class DMM34401A:
         self.ser.close()
 
     def read_ID(self):
-        output = self.ser.write("*IDN?\n".encode())
+        output = self.ser.write(_CMD_IDN)
         return output
 
     def set_CONF(self, conf, val_range=1, val_res=0.001):
@@ -147,24 +392,9 @@ class DMM34401A:
             val_range (int, optional): Approximate range of measurement in standard units. Defaults to 1.
             val_res (float, optional): Measurement resolution in standard units. Defaults to 0.001.
         """
-        if conf == "DCV": # DC voltage
-            self.ser.write(f"CONF:VOLT:DC {val_range}, {val_res}\n".encode())
-        elif conf == "ACV": # AC voltage
-            self.ser.write(f"CONF:VOLT:AC {val_range}, {val_res}\n".encode())
-        elif conf == "DCI": # DC current
-            self.ser.write(f"CONF:CURR:DC {val_range}, {val_res}\n".encode())
-        elif conf == "ACI": # AC current
-            self.ser.write(f"CONF:CURR:AC {val_range}, {val_res}\n".encode())
-        elif conf == "RES2": # 2-wire resistance
-            self.ser.write(f"CONF:RES {val_range}, {val_res}\n".encode())
-        elif conf == "RES4": # 4-wire resistance
-            self.ser.write(f"CONF:FRES {val_range}, {val_res}\n".encode())
-        elif conf == "FREQ": # Frequency
-            self.ser.write(f"CONF:FREQ {val_range}, {val_res}\n".encode())
-        elif conf == "PER": # Period
-            self.ser.write(f"CONF:PER {val_range}, {val_res}\n".encode())
-        else:
-            pass
+        tmpl = _CONF_CMDS.get(conf)
+        if tmpl is not None:
+            self.ser.write(tmpl % (str(val_range).encode(), str(val_res).encode()))
 
     def set_TRIG(self, val="IMM"):
         """Set trigger for measurement..
@@ -172,21 +402,159 @@ class DMM34401A:
         Args:
             val (str, optional): Trigger source. Can be IMMediate, BUS, or EXTernal. Defaults to "IMM".
         """
-        self.ser.write(f"TRIG:SOUR {val}\n".encode())
+        self.ser.write(_CMD_TRIG % val.encode())
 
-    def read_meas(self):
-        """Take a measurement from the DMM.
+    def _readline(self):
+        """Read one reply line from the DMM.
+
+        Everything already waiting on the port is pulled in one read, instead of pyserial's byte-at-a-time readline.
+
+        Returns:
+            bytes: Reply line including the line terminator.
+        """
+        line = self._take_line()
+        while line is None:
+            if self._fill():
+                line = self._take_line()
+            else:
+                # Timed out, return the partial reply as pyserial's readline does
+                line = bytes(self._rxmv[:self._rxlen])
+                self._rxlen = 0
+
+        return line
+
+    def _take_line(self):
+        """Remove the first complete line from the receive buffer.
+
+        Returns:
+            bytes or None: Reply line including the line terminator, or None if no full line has been received.
+        """
+        end = self._rxbuf.find(b"\n", 0, self._rxlen)
+        if end < 0:
+            return None
+
+        line = bytes(self._rxmv[:end + 1])
+        # Keep anything received after the line for the next call
+        rest = self._rxmv[end + 1:self._rxlen].tobytes()
+        self._rxmv[:len(rest)] = rest
+        self._rxlen = len(rest)
+        return line
+
+    def _fill(self):
+        """Read the bytes waiting on the port into the receive buffer.
+
+        Blocks until at least one byte arrives, or until ser.timeout expires if one is set.
+
+        Returns:
+            int: Number of bytes read, 0 if the read timed out.
+        """
+        if self._rxlen == len(self._rxbuf):
+            # The memoryview must be released before the bytearray can be resized
+            self._rxmv.release()
+            self._rxbuf.extend(bytes(len(self._rxbuf)))
+            self._rxmv = memoryview(self._rxbuf)
+
+        if os.name != 'posix':
+            n = max(1, min(self.ser.in_waiting, len(self._rxbuf) - self._rxlen))
+            n = self.ser.readinto(self._rxmv[self._rxlen:self._rxlen + n])
+            self._rxlen += n
+            return n
+
+        # On POSIX replies are read from the (non-blocking) file descriptor directly
+        # It is looked up per call since the port may have been closed and reopened
+        fd = self.ser.fileno()
+
+        # readv fills the buffer in place and releases the GIL for the syscall, unlike pyserial's Python read loop
+        # With VMIN=0 an empty port reads as 0 bytes, so only a 0 read after select reports readiness is an error
+        waited = False
+        while True:
+            try:
+                n = os.readv(fd, [self._rxmv[self._rxlen:]])
+            except BlockingIOError:
+                n = 0
+            if n:
+                break
+            if waited:
+                raise serial.SerialException('device reports readiness to read but returned no data '
+                                             '(device disconnected or multiple access on port?)')
+            ready, _, _ = select.select([fd], [], [], self.ser.timeout)
+            if not ready:
+                return 0
+            waited = True
+        self._rxlen += n
+        return n
+
+    def read_burst(self, n, interval=0):
+        """Take a burst of measurements from one trigger and fetch them in a single transfer.
+
+        The DMM is left in bus-triggered multi-sample mode. Call set_CONF to return to single reads.
+
+        Args:
+            n (int): Number of samples, up to MAX_BURST readings the DMM can store.
+            interval (float, optional): Delay between samples in sec. Defaults to 0.
+
+        Returns:
+            tuple: DMM measurements (np.array), and the time.monotonic() times the burst was triggered and finished.
+        """
+        with self.lock:
+            self.ser.write(_CMD_SAMP_COUN % n)
+            self.ser.write(_CMD_TRIG % b"BUS")
+            self.ser.write(_CMD_TRIG_DEL % interval)
+            self.ser.write(_CMD_INIT)
+            self.ser.write(_CMD_TRG)
+            t_start = time.monotonic()
+            # *OPC? answers once all samples are taken, so the end time excludes transferring the readings
+            self.ser.write(_CMD_OPC)
+            self._readline()
+            t_end = time.monotonic()
+            self.ser.write(_CMD_FETCH)
+            temp = self._readline()
+
+        return np.fromstring(temp, sep=','), t_start, t_end
+
+    def send_read(self):
+        """Trigger a measurement without waiting for the result."""
+        self.ser.write(_CMD_READ)
+
+    def recv_meas(self):
+        """Read back a measurement triggered by send_read.
 
         Returns:
             float: DMM measurement.
         """
+        # float parses the bytes directly and ignores the trailing CR/LF
         try:
-            self.ser.write("READ?\n".encode())
-            temp = self.ser.readline()
-            output = float(temp[:-2])
+            temp = self._readline()
+            output = float(temp)
         except ValueError:
             print(temp)
-            temp = self.ser.readline()
-            output = float(temp[:-2])
+            temp = self._readline()
+            output = float(temp)
 
         return output
+
+    def poll_meas(self):
+        """Parse a measurement triggered by send_read if its reply has already been received.
+
+        Returns:
+            float or None: DMM measurement, or None if the reply is not complete yet.
+        """
+        temp = self._take_line()
+        while temp is not None:
+            try:
+                return float(temp)
+            except ValueError:
+                print(temp)
+                temp = self._take_line()
+
+        return None
+
+    def read_meas(self):
+        """Take a measurement from the DMM.
+
+        Returns:
+            float: DMM measurement.
+        """
+        with self.lock:
+            self.send_read()
+            return self.recv_meas()
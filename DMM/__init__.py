@@ -0,0 +1 @@
+from .DMM34401A import read_DMMs, init_DMMs, del_DMMs, read_ports
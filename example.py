@@ -4,12 +4,17 @@ import matplotlib.pyplot as plt
 from DMM import DMM34401A
 
 def WB (Vout, R1, R2, R3, Vs):
-    Rx = (R2*Vs - (R1+R2)*Vout)/(R1*Vs + (R1+R2)*Vout)*R3
+    # Rx = (R2*Vs - (R1+R2)*Vout)/(R1*Vs + (R1+R2)*Vout)*R3, evaluated in place to avoid temporaries
+    v = np.asarray(Vout, dtype=np.float64)
+    Rx = np.multiply(R1 + R2, v)
+    den = np.add(R1*Vs, Rx)
+    np.subtract(R2*Vs, Rx, out=Rx)
+    np.divide(Rx, den, out=Rx)
+    np.multiply(Rx, R3, out=Rx)
     return Rx
 
-a = DMM34401A.read_DMMs('DCV')
 filename = "WheatStone_Vout.csv"
-np.savetxt(filename, a, delimiter=",", fmt = '%10.8f')
+DMM34401A.read_DMMs('DCV', csv_path=filename)
 
 df0 = pd.read_csv(filename, header=None, names=np.array(['time', 'volt']))
 print(df0.head())
@@ -0,0 +1,188 @@
+"""Tests for DMM34401A against fake DMMs on pseudo-terminals."""
+
+import os
+import time
+import tty
+import threading
+import selectors
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+from DMM import DMM34401A as dmm_module
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason="pseudo-terminals are POSIX only")
+
+
+def fake_dmm(value=None, fetch_delay=0):
+    """Open a pseudo-terminal for a fake DMM.
+
+    Args:
+        value (float, optional): If given, answer READ? with this value and FETCh? with value + k for each sample.
+            Otherwise nothing is answered and the test writes replies to the master fd itself. Defaults to None.
+        fetch_delay (float, optional): Delay before answering FETCh? in sec, standing in for the transfer time.
+            Defaults to 0.
+
+    Returns:
+        tuple: Slave port path and master fd.
+    """
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    port = os.ttyname(slave)
+
+    def respond():
+        buf = b''
+        count = 1
+        while True:
+            try:
+                data = os.read(master, 256)
+            except OSError:
+                return
+            buf += data
+            while b'\n' in buf:
+                line, buf = buf.split(b'\n', 1)
+                if line.startswith(b'SAMP:COUN'):
+                    count = int(line.split()[1])
+                elif line == b'READ?':
+                    os.write(master, b'%+.8E\r\n' % value)
+                elif line == b'*OPC?':
+                    os.write(master, b'1\r\n')
+                elif line == b'FETCh?':
+                    # time.sleep may be patched out by the test, so wait on an event instead
+                    threading.Event().wait(fetch_delay)
+                    os.write(master, b','.join(b'%+.8E' % (value + k) for k in range(count)) + b'\r\n')
+
+    if value is not None:
+        threading.Thread(target=respond, daemon=True).start()
+    return port, master
+
+
+@pytest.fixture
+def no_sleep(monkeypatch):
+    """Skip the settle sleeps in DMM34401A and read_DMMs."""
+    monkeypatch.setattr(dmm_module.time, 'sleep', lambda sec: None)
+
+
+@pytest.fixture
+def silent_dmm(no_sleep):
+    """DMM object whose replies are written by the test through the returned master fd."""
+    port, master = fake_dmm()
+    dmm = dmm_module.DMM34401A(port)
+    yield dmm, master
+    dmm.ser.close()
+    os.close(master)
+
+
+def test_recv_meas_split_reply(silent_dmm):
+    dmm, master = silent_dmm
+    os.write(master, b'+1.2345')
+    threading.Timer(0.05, os.write, args=(master, b'6789E-01\r\n')).start()
+
+    assert dmm.recv_meas() == pytest.approx(0.123456789)
+
+
+def test_recv_meas_coalesced_replies(silent_dmm):
+    dmm, master = silent_dmm
+    os.write(master, b'+1.0E+00\r\n+2.0E+00\r\n')
+
+    assert dmm.recv_meas() == 1.0
+    assert dmm.poll_meas() == 2.0
+    assert dmm.poll_meas() is None
+
+
+def test_recv_meas_skips_bad_line(silent_dmm, capsys):
+    dmm, master = silent_dmm
+    os.write(master, b'garbage\r\n+3.0E+00\r\n')
+
+    assert dmm.recv_meas() == 3.0
+    assert 'garbage' in capsys.readouterr().out
+
+
+def test_fill_times_out(silent_dmm):
+    dmm, _ = silent_dmm
+    dmm.ser.timeout = 0.05
+
+    assert dmm._fill() == 0
+
+
+def test_read_burst_grows_buffer(no_sleep):
+    port, master = fake_dmm(0.5)
+    dmm = dmm_module.DMM34401A(port)
+    try:
+        # 40 readings is ~640 bytes, well past the initial 64 byte buffer
+        values, t_start, t_end = dmm.read_burst(40)
+    finally:
+        dmm.ser.close()
+        os.close(master)
+
+    np.testing.assert_allclose(values, 0.5 + np.arange(40))
+    assert t_start <= t_end
+
+
+def test_read_DMMs_burst_time_excludes_fetch(no_sleep):
+    fakes = [fake_dmm(value, fetch_delay=0.3) for value in (0.1, 0.2)]
+    dmms = [dmm_module.DMM34401A(port) for port, _ in fakes]
+    try:
+        data = dmm_module.read_DMMs('DCV', dmms, meas_time=0.01, batch=8)
+    finally:
+        for dmm, (_, master) in zip(dmms, fakes):
+            dmm.ser.close()
+            os.close(master)
+
+    # The first burst's time column spans the sampling only, not the delayed FETCh? reply
+    assert data[7, 0] - data[0, 0] < 0.1
+
+
+def test_select_read(no_sleep):
+    fakes = [fake_dmm(value) for value in (0.1, 0.2, 0.3)]
+    dmms = [dmm_module.DMM34401A(port) for port, _ in fakes]
+    out = np.empty(len(dmms))
+    try:
+        with selectors.DefaultSelector() as sel:
+            dmm_module._select_read(dmms, sel, out)
+            assert not sel.get_map()
+    finally:
+        for dmm, (_, master) in zip(dmms, fakes):
+            dmm.ser.close()
+            os.close(master)
+
+    np.testing.assert_allclose(out, [0.1, 0.2, 0.3])
+
+
+@pytest.mark.parametrize('batch', [0, 4])
+def test_read_DMMs_csv(no_sleep, tmp_path, batch):
+    fakes = [fake_dmm(value) for value in (0.1, 0.2)]
+    dmms = [dmm_module.DMM34401A(port) for port, _ in fakes]
+    csv_path = tmp_path / 'out.csv'
+    try:
+        result = dmm_module.read_DMMs('DCV', dmms, meas_time=0.05, batch=batch, csv_path=str(csv_path))
+    finally:
+        for dmm, (_, master) in zip(dmms, fakes):
+            dmm.ser.close()
+            os.close(master)
+
+    assert result is None
+    data = np.loadtxt(csv_path, delimiter=',', ndmin=2)
+    assert data.shape[1] == 3
+    assert np.all(np.diff(data[:, 0]) >= 0)
+    if batch:
+        np.testing.assert_allclose(data[:batch, 1], 0.1 + np.arange(batch))
+    else:
+        np.testing.assert_allclose(data[:, 1:], [[0.1, 0.2]] * len(data))
+
+
+def test_read_DMMs_rejects_large_batch(no_sleep):
+    with pytest.raises(ValueError):
+        dmm_module.read_DMMs('DCV', [object()], batch=dmm_module.MAX_BURST + 1)
+
+
+def test_read_ports_matches_adapter_vids(monkeypatch):
+    comports = [
+        SimpleNamespace(device='COM5', vid=0x067B), # Prolific USB-serial adapter
+        SimpleNamespace(device='COM4', vid=None), # Bluetooth serial
+        SimpleNamespace(device='/dev/ttyACM0', vid=0x2341), # Arduino
+    ]
+    monkeypatch.setattr(dmm_module.serial.tools.list_ports, 'comports', lambda: comports)
+
+    assert dmm_module.read_ports(force=True) == ['COM5']